@@ -6,62 +6,262 @@ Cisco SD-WAN Site Hierarchy with Reverse Geocoding - Clean Version
 import requests
 import json
 import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 from collections import defaultdict
+from dataclasses import dataclass, fields
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import io
+import os
 import sys
+import sqlite3
+import tempfile
+import threading
 import time
+from urllib.parse import urlsplit
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Disable SSL warnings for sandbox environment
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+NOMINATIM_PUBLIC_URL = "https://nominatim.openstreetmap.org/reverse"
+NOMINATIM_PUBLIC_HOST = "nominatim.openstreetmap.org"
+
+DEFAULT_GEOCODE_CACHE = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+    'sdwan_device_location', 'geocode_cache.sqlite'
+)
+
+# Nominatim address fields, in order of preference
+_CITY_KEYS = ('city', 'town', 'village', 'hamlet')
+_STATE_KEYS = ('state', 'province')
+
+# Field names for the (color, control_connections_up, bfd_sessions_up) TLOC
+# tuples, used to label them again in the JSON export
+_TLOC_FIELDS = ('color', 'control_connections_up', 'bfd_sessions_up')
+
+@dataclass(slots=True)
+class DeviceInfo:
+    """Per-device record stored under each site"""
+    hostname: str
+    system_ip: str
+    device_type: str
+    device_model: str
+    reachability: str
+    version: str
+    platform: str
+    location: dict | None = None
+    tloc_info: list | None = None
+
+# Nominatim responses worth retrying
+_RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+def _json_loads(content):
+    """Parse a JSON response body, using orjson when it is installed"""
+    return orjson.loads(content) if orjson is not None else json.loads(content)
+
+def _is_read_error(exc):
+    """Return True if a request reached the server but failed reading the response"""
+    if isinstance(exc, requests.exceptions.ReadTimeout):
+        return True
+    cause = exc.args[0] if exc.args else None
+    cause = getattr(cause, 'reason', cause)
+    return isinstance(cause, (urllib3.exceptions.ReadTimeoutError, urllib3.exceptions.ProtocolError))
+
+def _is_timeout(exc):
+    """Return True if a request failed because it timed out"""
+    if isinstance(exc, requests.exceptions.Timeout):
+        return True
+    # With retries mounted, an exhausted read timeout surfaces as a
+    # ConnectionError wrapping MaxRetryError(reason=ReadTimeoutError)
+    reason = getattr(exc.args[0], 'reason', None) if exc.args else None
+    return isinstance(reason, urllib3.exceptions.ReadTimeoutError)
+
+def _first(d, keys, default=None):
+    """Return the first truthy value in d for the given keys"""
+    for k in keys:
+        v = d.get(k)
+        if v:
+            return v
+    return default
+
 class GeocodeService:
     """Service for reverse geocoding GPS coordinates to addresses"""
     
-    def __init__(self):
+    def __init__(self, cache_path=None, cache_ttl=30 * 24 * 3600, url=None):
         self.cache = {}  # Cache to avoid repeated API calls
+        self.cache_ttl = cache_ttl
+        self.url = url or os.environ.get('NOMINATIM_URL', NOMINATIM_PUBLIC_URL)
+        
+        # The public service allows one request per second; private instances can take more
+        is_public = urlsplit(self.url).hostname == NOMINATIM_PUBLIC_HOST
+        self.max_workers = 1 if is_public else 8
+        self.min_interval = 1.0 if is_public else 0.0
+        self._next_allowed_ts = 0.0
+        self._throttle_lock = threading.Lock()
+        
+        # Reuse keep-alive connections for all Nominatim requests, one per worker
+        self.session = requests.Session()
+        self.session.headers.update({'User-Agent': 'SD-WAN-Location-Mapper/1.0'})
+        # urllib3 only retries failed connects, which never reach the server; reads and
+        # 429/5xx responses are retried in _fetch so every attempt goes through _throttle
+        self.max_attempts = 4
+        self.backoff_factor = 1.5
+        retries = Retry(total=3, connect=3, read=0, status=0, other=0,
+                        backoff_factor=self.backoff_factor, allowed_methods=['GET'])
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(4, self.max_workers),
+                              max_retries=retries)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        
+        # Persistent cache so reruns don't hit Nominatim for known sites; if it
+        # can't be opened, fall back to the in-memory cache only
+        cache_path = cache_path or os.environ.get('SDWAN_GEOCACHE', DEFAULT_GEOCODE_CACHE)
+        self.db_lock = threading.Lock()
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+            self.db = sqlite3.connect(cache_path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS geo(key TEXT PRIMARY KEY, json TEXT, ts INTEGER)"
+            )
+            self.db.commit()
+        except (OSError, sqlite3.Error) as e:
+            print(f"WARNING: Geocode cache {cache_path} unavailable, not persisting results: {str(e)}")
+            self.db = None
+        
+    @staticmethod
+    def _cache_key(lat, lon):
+        """Round coordinates to ~1m so GPS jitter maps to the same cache entry"""
+        return (round(float(lat), 5), round(float(lon), 5))
+    
+    @staticmethod
+    def _db_key(key):
+        """Format a cache key as a stable string for the SQLite table"""
+        return f"{key[0]:.5f},{key[1]:.5f}"
+    
+    def _load_cached(self, key):
+        """Return a cached location from disk, or None if missing or stale"""
+        if self.db is None:
+            return None
+        try:
+            with self.db_lock:
+                row = self.db.execute("SELECT json, ts FROM geo WHERE key=?",
+                                      (self._db_key(key),)).fetchone()
+        except sqlite3.Error as e:
+            print(f"WARNING: Geocode cache read failed: {str(e)}")
+            return None
+        if row and (self.cache_ttl is None or time.time() - row[1] < self.cache_ttl):
+            return json.loads(row[0])
+        return None
+    
+    def _store_cached(self, key, location_info):
+        """Save a geocoded location to the disk cache"""
+        if self.db is None:
+            return
+        try:
+            with self.db_lock:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO geo(key, json, ts) VALUES (?, ?, ?)",
+                    (self._db_key(key), json.dumps(location_info), int(time.time()))
+                )
+                self.db.commit()
+        except sqlite3.Error as e:
+            print(f"WARNING: Geocode cache write failed: {str(e)}")
+    
+    def _throttle(self):
+        """Block until the next Nominatim request is allowed by the rate limit"""
+        with self._throttle_lock:
+            now = time.monotonic()
+            wait = self._next_allowed_ts - now
+            if wait > 0:
+                time.sleep(wait)
+            self._next_allowed_ts = max(now, self._next_allowed_ts) + self.min_interval
+    
+    def get_cached(self, lat, lon):
+        """Return a previously geocoded location without any network access"""
+        key = self._cache_key(lat, lon)
+        if key in self.cache:
+            return self.cache[key]
+        
+        cached = self._load_cached(key)
+        if cached:
+            self.cache[key] = cached
+        return cached
         
     def reverse_geocode_nominatim(self, lat, lon):
         """Use OpenStreetMap Nominatim service (free, no API key required)"""
-        if f"{lat},{lon}" in self.cache:
-            return self.cache[f"{lat},{lon}"]
-        
+        cached = self.get_cached(lat, lon)
+        if cached:
+            return cached
+        return self._fetch(self._cache_key(lat, lon), lat, lon)
+    
+    def _fetch(self, key, lat, lon):
+        """Geocode a location via Nominatim without checking the cache first"""
         try:
-            url = "https://nominatim.openstreetmap.org/reverse"
             params = {
                 'lat': lat,
                 'lon': lon,
                 'format': 'json',
                 'addressdetails': 1
             }
-            headers = {
-                'User-Agent': 'SD-WAN-Location-Mapper/1.0'
-            }
             
-            response = requests.get(url, params=params, headers=headers, timeout=10)
-            time.sleep(1)  # Be respectful to free service
+            for attempt in range(1, self.max_attempts + 1):
+                self._throttle()  # Be respectful to free service
+                retry_after = ''
+                try:
+                    response = self.session.get(self.url, params=params, timeout=20)
+                except requests.exceptions.RequestException as e:
+                    if attempt == self.max_attempts or not _is_read_error(e):
+                        raise
+                else:
+                    if response.status_code not in _RETRY_STATUSES or attempt == self.max_attempts:
+                        break
+                    retry_after = response.headers.get('Retry-After', '')
+                
+                # Back off before the next attempt, honoring Retry-After when given
+                delay = self.backoff_factor * 2 ** (attempt - 1)
+                if retry_after.isdigit():
+                    delay = max(delay, int(retry_after))
+                time.sleep(delay)
             
             if response.status_code == 200:
                 data = response.json()
                 address = data.get('address', {})
+                city = _first(address, _CITY_KEYS)
+                state = _first(address, _STATE_KEYS)
+                country = address.get('country')
                 
                 location_info = {
                     'display_name': data.get('display_name', 'Unknown Location'),
-                    'city': (address.get('city') or 
-                            address.get('town') or 
-                            address.get('village') or 
-                            address.get('hamlet', 'Unknown City')),
-                    'state': (address.get('state') or 
-                             address.get('province', 'Unknown State')),
-                    'country': address.get('country', 'Unknown Country'),
+                    'city': city or 'Unknown City',
+                    'state': state or 'Unknown State',
+                    'country': country or 'Unknown Country',
                     'country_code': address.get('country_code', '').upper(),
                     'postcode': address.get('postcode', ''),
-                    'formatted_address': self._format_address(address)
+                    'formatted_address': self._format_address(city, state, country)
                 }
                 
-                self.cache[f"{lat},{lon}"] = location_info
+                self.cache[key] = location_info
+                self._store_cached(key, location_info)
                 return location_info
-                
+            
+            print(f"WARNING: Geocoding failed for {lat},{lon}: HTTP {response.status_code}")
+            
         except Exception as e:
-            print(f"WARNING: Geocoding failed for {lat},{lon}: {str(e)}")
+            # Failures are not cached, so the next run will try this location again
+            if _is_timeout(e):
+                print(f"WARNING: Geocoding timed out for {lat},{lon} after retries")
+            else:
+                print(f"WARNING: Geocoding failed for {lat},{lon}: {str(e)}")
         
         return {
             'display_name': f'Location at {lat}, {lon}',
@@ -73,26 +273,21 @@ class GeocodeService:
             'formatted_address': f'{lat}, {lon}'
         }
     
-    def _format_address(self, address):
+    def _format_address(self, city, state, country):
         """Format address components into readable string"""
         components = []
         
         # Add city/town
-        city = (address.get('city') or 
-                address.get('town') or 
-                address.get('village') or 
-                address.get('hamlet'))
         if city:
             components.append(city)
         
         # Add state/province
-        state = address.get('state') or address.get('province')
         if state:
             components.append(state)
         
         # Add country
-        if address.get('country'):
-            components.append(address.get('country'))
+        if country:
+            components.append(country)
         
         return ', '.join(components) if components else 'Unknown Location'
 
@@ -103,11 +298,15 @@ class SDWANSiteExtractorWithGeo:
         self.password = password
         self.session = requests.Session()
         self.session.verify = False
+        # Keep the vManage TLS connection alive between auth and data pulls
+        self.session.mount(self.base_url, HTTPAdapter(pool_connections=2, pool_maxsize=4,
+                                                      max_retries=Retry(total=2, backoff_factor=0.5)))
+        self.session.headers['Connection'] = 'keep-alive'
         self.token = None
         self.geocoder = GeocodeService()
         
     def authenticate(self):
-        """Authenticate and get session token"""
+        """Authenticate and establish a session"""
         auth_url = f"{self.base_url}/j_security_check"
         auth_data = {
             'j_username': self.username,
@@ -116,39 +315,55 @@ class SDWANSiteExtractorWithGeo:
         
         response = self.session.post(auth_url, data=auth_data)
         
-        if response.status_code == 200:
+        # vManage answers a failed login with the HTML login page instead of an error code
+        return response.status_code == 200 and '<html' not in response.text.lower()
+    
+    def _ensure_token(self):
+        """Fetch the XSRF token on first use; only needed for non-GET requests"""
+        if self.token is None:
             token_url = f"{self.base_url}/dataservice/client/token"
             token_response = self.session.get(token_url)
-            if token_response.status_code == 200:
-                self.token = token_response.text
-                self.session.headers.update({'X-XSRF-TOKEN': self.token})
-                return True
-        return False
+            if token_response.status_code != 200:
+                return False
+            self.token = token_response.text
+            self.session.headers.update({'X-XSRF-TOKEN': self.token})
+        return True
     
     def get_devices(self):
         """Get all devices"""
         url = f"{self.base_url}/dataservice/device"
+        if orjson is None and ijson is not None:
+            # Stream-decode the device list so the raw body is never held in memory
+            with self.session.get(url, stream=True) as response:
+                if response.status_code != 200:
+                    return None
+                response.raw.decode_content = True
+                return {'data': list(ijson.items(response.raw, 'data.item', use_float=True))}
+        
         response = self.session.get(url)
-        return response.json() if response.status_code == 200 else None
+        return _json_loads(response.content) if response.status_code == 200 else None
     
     def get_tloc_data(self):
         """Get TLOC data for additional network topology info"""
         url = f"{self.base_url}/dataservice/device/tloc"
         response = self.session.get(url)
-        return response.json() if response.status_code == 200 else None
+        return _json_loads(response.content) if response.status_code == 200 else None
     
     def extract_sites_with_geocoding(self):
         """Extract sites and add geocoded location information"""
         
-        print("Getting device data...")
-        devices_data = self.get_devices()
+        # Device and TLOC data are independent, so fetch them in parallel
+        print("Getting device and TLOC data...")
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            devices_future = executor.submit(self.get_devices)
+            tloc_future = executor.submit(self.get_tloc_data)
+            devices_data = devices_future.result()
+            tloc_data = tloc_future.result()
+        
         if not devices_data or 'data' not in devices_data:
             print("ERROR: Failed to get device data")
             return None
         
-        print("Getting TLOC data...")
-        tloc_data = self.get_tloc_data()
-        
         print("Processing devices and geocoding locations...")
         
         sites = defaultdict(lambda: {
@@ -158,44 +373,93 @@ class SDWANSiteExtractorWithGeo:
             'site_type': 'unknown'
         })
         
+        # Index TLOC information by system IP so it can be attached per device,
+        # as (color, control_connections_up, bfd_sessions_up) tuples
+        tloc_by_system_ip = defaultdict(list)
+        for tloc in (tloc_data or {}).get('data', ()):
+            system_ip = tloc.get('system-ip')
+            if system_ip:
+                tloc_by_system_ip[system_ip].append((
+                    tloc.get('color', 'N/A'),
+                    tloc.get('controlConnectionsUp', 0),
+                    tloc.get('bfdSessionsUp', 0)
+                ))
+        
+        devices = devices_data['data']
+        total = len(devices)
+        
+        # Only the first device location per site is kept, so only those are geocoded
+        site_coords = {}
+        for device in devices:
+            site_id = device.get('site-id', 'unknown')
+            if site_id not in site_coords and device.get('latitude') and device.get('longitude'):
+                lat = round(float(device.get('latitude')), 5)
+                lon = round(float(device.get('longitude')), 5)
+                site_coords[site_id] = (lat, lon)
+        
+        # Collect unique coordinates so each location is geocoded only once
+        unique_coords = set(site_coords.values())
+        
+        # Reverse geocode each unique location, only sending cache misses to the pool
+        geocoded_by_coords = {}
+        misses = []
+        for coords in unique_coords:
+            cached = self.geocoder.get_cached(*coords)
+            if cached:
+                geocoded_by_coords[coords] = cached
+            else:
+                misses.append(coords)
+        
+        print(f"   {len(geocoded_by_coords)} locations cached, geocoding {len(misses)}...")
+        with ThreadPoolExecutor(max_workers=self.geocoder.max_workers) as executor:
+            futures = {
+                executor.submit(self.geocoder._fetch, (lat, lon), lat, lon): (lat, lon)
+                for lat, lon in misses
+            }
+            for i, future in enumerate(as_completed(futures)):
+                lat, lon = futures[future]
+                print(f"   Geocoded {i+1}/{len(misses)}: {lat}, {lon}")
+                geocoded_by_coords[(lat, lon)] = future.result()
+        sys.stdout.flush()
+        
         # Process each device
-        for i, device in enumerate(devices_data['data']):
+        for i, device in enumerate(devices):
             site_id = device.get('site-id', 'unknown')
             
-            print(f"Processing device {i+1}/{len(devices_data['data'])}: {device.get('host-name', 'Unknown')}")
+            print(f"Processing device {i+1}/{total}: {device.get('host-name', 'Unknown')}")
             
-            device_info = {
-                'hostname': device.get('host-name', 'N/A'),
-                'system_ip': device.get('system-ip', 'N/A'),
-                'device_type': device.get('device-type', 'N/A'),
-                'device_model': device.get('device-model', 'N/A'),
-                'reachability': device.get('reachability', 'N/A'),
-                'version': device.get('version', 'N/A'),
-                'platform': device.get('platform', 'N/A')
-            }
+            device_info = DeviceInfo(
+                hostname=device.get('host-name', 'N/A'),
+                system_ip=device.get('system-ip', 'N/A'),
+                device_type=device.get('device-type', 'N/A'),
+                device_model=device.get('device-model', 'N/A'),
+                reachability=device.get('reachability', 'N/A'),
+                version=device.get('version', 'N/A'),
+                platform=device.get('platform', 'N/A')
+            )
+            
+            # Add TLOC information if available
+            if device_info.system_ip in tloc_by_system_ip:
+                device_info.tloc_info = tloc_by_system_ip[device_info.system_ip]
             
             # Process location data
-            if device.get('latitude') and device.get('longitude'):
-                lat = float(device.get('latitude'))
-                lon = float(device.get('longitude'))
-                
+            lat_raw = device.get('latitude')
+            lon_raw = device.get('longitude')
+            if lat_raw and lon_raw:
+                site = sites[site_id]
                 location_info = {
-                    'latitude': lat,
-                    'longitude': lon,
+                    'latitude': float(lat_raw),
+                    'longitude': float(lon_raw),
                     'is_device_gps': device.get('isDeviceGeoData', False)
                 }
                 
-                # Perform reverse geocoding
-                print(f"   Geocoding {lat}, {lon}...")
-                geocoded = self.geocoder.reverse_geocode_nominatim(lat, lon)
-                location_info['geocoded'] = geocoded
-                
-                # Use first device's location as site location
-                if not sites[site_id]['location']:
-                    sites[site_id]['location'] = location_info
-                    sites[site_id]['geocoded_location'] = geocoded
+                # Use first device's location as site location; later devices reuse its address
+                if site['location'] is None:
+                    site['location'] = location_info
+                    site['geocoded_location'] = geocoded_by_coords[site_coords[site_id]]
+                location_info['geocoded'] = site['geocoded_location']
                 
-                device_info['location'] = location_info
+                device_info.location = location_info
             
             # Determine site type
             if device.get('device-type') in ['vmanage', 'vsmart', 'vbond']:
@@ -204,122 +468,128 @@ class SDWANSiteExtractorWithGeo:
                 sites[site_id]['site_type'] = 'branch'
             
             sites[site_id]['devices'].append(device_info)
-        
-        # Add TLOC information if available
-        tloc_by_system_ip = {}
-        if tloc_data and 'data' in tloc_data:
-            for tloc in tloc_data['data']:
-                system_ip = tloc.get('system-ip')
-                if system_ip:
-                    if system_ip not in tloc_by_system_ip:
-                        tloc_by_system_ip[system_ip] = []
-                    tloc_by_system_ip[system_ip].append({
-                        'color': tloc.get('color', 'N/A'),
-                        'control_connections_up': tloc.get('controlConnectionsUp', 0),
-                        'bfd_sessions_up': tloc.get('bfdSessionsUp', 0)
-                    })
-        
-        # Add TLOC info to devices
-        for site_id, site_info in sites.items():
-            for device in site_info['devices']:
-                system_ip = device['system_ip']
-                if system_ip in tloc_by_system_ip:
-                    device['tloc_info'] = tloc_by_system_ip[system_ip]
+        sys.stdout.flush()
         
         return dict(sites)
 
-def print_geocoded_site_report(sites):
+def _print_site_block(title, site_dict, buf, show_gps_type=False, show_tloc=False):
+    """Write one section of the site report"""
+    if not site_dict:
+        return
+    
+    buf.write(f"\n{title}\n")
+    buf.write("-" * 40 + "\n")
+    for site_id, site_info in site_dict.items():
+        buf.write(f"\nSite {site_id} ({len(site_info['devices'])} devices)\n")
+        
+        if site_info['geocoded_location']:
+            geo = site_info['geocoded_location']
+            loc = site_info['location']
+            if show_gps_type:
+                label = "Device GPS" if loc['is_device_gps'] else "Site Location"
+            else:
+                label = "Location"
+            
+            buf.write(f"   {label}: {geo['formatted_address']}\n")
+            buf.write(f"   City: {geo['city']}, {geo['state']}, {geo['country']} {geo['country_code']}\n")
+            if geo['postcode']:
+                buf.write(f"   Postal Code: {geo['postcode']}\n")
+            buf.write(f"   Coordinates: {loc['latitude']}, {loc['longitude']}\n")
+        
+        for device in site_info['devices']:
+            status = "ONLINE" if device.reachability == 'reachable' else "OFFLINE"
+            buf.write(f"   [{status}] {device.hostname} ({device.device_type})\n")
+            buf.write(f"      System IP: {device.system_ip}, Model: {device.device_model}\n")
+            buf.write(f"      Version: {device.version}, Platform: {device.platform}\n")
+            
+            # Show TLOC info if available
+            if show_tloc and device.tloc_info:
+                buf.write("      Network Connections:\n")
+                for color, control_up, bfd_up in device.tloc_info:
+                    buf.write(f"        {color}: {control_up} control, {bfd_up} BFD\n")
+
+def print_geocoded_site_report(sites, out=None):
     """Print site report with geocoded location information"""
     
-    print("\n" + "="*80)
-    print("CISCO SD-WAN SITES WITH GEOCODED LOCATIONS")
-    print("="*80)
+    # Build the whole report in memory and write it out once
+    buf = io.StringIO()
+    
+    buf.write("\n" + "="*80 + "\n")
+    buf.write("CISCO SD-WAN SITES WITH GEOCODED LOCATIONS\n")
+    buf.write("="*80 + "\n")
     
-    print(f"\nSummary: {len(sites)} sites discovered")
+    buf.write(f"\nSummary: {len(sites)} sites discovered\n")
     
-    # Categorize sites
-    control_sites = {k: v for k, v in sites.items() if v['site_type'] == 'control_plane'}
-    branch_sites = {k: v for k, v in sites.items() if v['site_type'] == 'branch'}
+    # Categorize sites in a single pass
+    control_sites, branch_sites = {}, {}
+    for site_id, site_info in sites.items():
+        if site_info['site_type'] == 'control_plane':
+            control_sites[site_id] = site_info
+        else:
+            branch_sites[site_id] = site_info
     
-    print(f"   Control Plane Sites: {len(control_sites)}")
-    print(f"   Branch Sites: {len(branch_sites)}")
+    buf.write(f"   Control Plane Sites: {len(control_sites)}\n")
+    buf.write(f"   Branch Sites: {len(branch_sites)}\n")
     
-    # Control Plane Sites
-    if control_sites:
-        print(f"\nCONTROL PLANE SITES")
-        print("-" * 40)
-        for site_id, site_info in control_sites.items():
-            print(f"\nSite {site_id} ({len(site_info['devices'])} devices)")
-            
-            if site_info['geocoded_location']:
-                geo = site_info['geocoded_location']
-                print(f"   Location: {geo['formatted_address']}")
-                print(f"   City: {geo['city']}, {geo['state']}, {geo['country']} {geo['country_code']}")
-                if geo['postcode']:
-                    print(f"   Postal Code: {geo['postcode']}")
-                print(f"   Coordinates: {site_info['location']['latitude']}, {site_info['location']['longitude']}")
-            
-            for device in site_info['devices']:
-                status = "ONLINE" if device['reachability'] == 'reachable' else "OFFLINE"
-                print(f"   [{status}] {device['hostname']} ({device['device_type']})")
-                print(f"      System IP: {device['system_ip']}, Model: {device['device_model']}")
-                print(f"      Version: {device['version']}, Platform: {device['platform']}")
-    
-    # Branch Sites
-    if branch_sites:
-        print(f"\nBRANCH SITES")
-        print("-" * 40)
-        for site_id, site_info in branch_sites.items():
-            print(f"\nSite {site_id} ({len(site_info['devices'])} devices)")
-            
-            if site_info['geocoded_location']:
-                geo = site_info['geocoded_location']
-                loc = site_info['location']
-                gps_type = "Device GPS" if loc['is_device_gps'] else "Site Location"
-                
-                print(f"   {gps_type}: {geo['formatted_address']}")
-                print(f"   City: {geo['city']}, {geo['state']}, {geo['country']} {geo['country_code']}")
-                if geo['postcode']:
-                    print(f"   Postal Code: {geo['postcode']}")
-                print(f"   Coordinates: {loc['latitude']}, {loc['longitude']}")
-            
-            for device in site_info['devices']:
-                status = "ONLINE" if device['reachability'] == 'reachable' else "OFFLINE"
-                print(f"   [{status}] {device['hostname']} ({device['device_type']})")
-                print(f"      System IP: {device['system_ip']}, Model: {device['device_model']}")
-                print(f"      Version: {device['version']}, Platform: {device['platform']}")
-                
-                # Show TLOC info if available
-                if 'tloc_info' in device:
-                    print(f"      Network Connections:")
-                    for tloc in device['tloc_info']:
-                        print(f"        {tloc['color']}: {tloc['control_connections_up']} control, {tloc['bfd_sessions_up']} BFD")
+    _print_site_block("CONTROL PLANE SITES", control_sites, buf)
+    _print_site_block("BRANCH SITES", branch_sites, buf, show_gps_type=True, show_tloc=True)
+    
+    (out or sys.stdout).write(buf.getvalue())
 
-def generate_location_summary(sites):
+def generate_location_summary(sites, out=None):
     """Generate a summary of all locations"""
     
-    print(f"\nLOCATION SUMMARY")
-    print("-" * 40)
+    buf = io.StringIO()
+    
+    buf.write("\nLOCATION SUMMARY\n")
+    buf.write("-" * 40 + "\n")
     
     countries = defaultdict(list)
     cities = defaultdict(list)
     
     for site_id, site_info in sites.items():
-        if site_info['geocoded_location']:
-            geo = site_info['geocoded_location']
-            country = geo['country']
-            city = geo['city']
-            
-            countries[country].append(f"Site {site_id}")
-            cities[f"{city}, {geo['state']}, {country}"].append(f"Site {site_id}")
+        geo = site_info['geocoded_location']
+        if not geo:
+            continue
+        
+        country = geo['country']
+        countries[country].append(f"Site {site_id}")
+        cities[f"{geo['city']}, {geo['state']}, {country}"].append(f"Site {site_id}")
     
-    print(f"\nCountries ({len(countries)}):")
+    buf.write(f"\nCountries ({len(countries)}):\n")
     for country, sites_list in sorted(countries.items()):
-        print(f"   {country}: {', '.join(sites_list)}")
+        buf.write(f"   {country}: {', '.join(sites_list)}\n")
     
-    print(f"\nCities ({len(cities)}):")
+    buf.write(f"\nCities ({len(cities)}):\n")
     for city, sites_list in sorted(cities.items()):
-        print(f"   {city}: {', '.join(sites_list)}")
+        buf.write(f"   {city}: {', '.join(sites_list)}\n")
+    
+    (out or sys.stdout).write(buf.getvalue())
+
+def _device_to_json(obj):
+    """JSON encoder hook exporting DeviceInfo records with named TLOC fields"""
+    if not isinstance(obj, DeviceInfo):
+        raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+    record = {field.name: getattr(obj, field.name) for field in fields(obj)}
+    
+    # location and tloc_info are only exported when the device has them
+    if obj.location is None:
+        del record['location']
+    if obj.tloc_info is None:
+        del record['tloc_info']
+    else:
+        record['tloc_info'] = [dict(zip(_TLOC_FIELDS, tloc)) for tloc in obj.tloc_info]
+    return record
+
+def save_sites_json(sites, output_file):
+    """Write the site hierarchy to a JSON file"""
+    if orjson is not None:
+        options = orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATACLASS
+        with open(output_file, 'wb') as f:
+            f.write(orjson.dumps(sites, default=_device_to_json, option=options))
+    else:
+        with open(output_file, 'w') as f:
+            json.dump(sites, f, indent=2, default=_device_to_json)
 
 def print_api_usage_guide():
     """Print API usage guide"""
@@ -400,7 +670,10 @@ def main():
     
     # Extract sites with geocoding
     print("\nExtracting sites with location mapping...")
-    sites = extractor.extract_sites_with_geocoding()
+    try:
+        sites = extractor.extract_sites_with_geocoding()
+    finally:
+        extractor.session.close()
     
     if sites:
         # Generate geocoded report
@@ -410,9 +683,11 @@ def main():
         generate_location_summary(sites)
         
         # Save results
-        output_file = '/Users/stuartclark/Downloads/sdwan_sites_geocoded_clean.json'
-        with open(output_file, 'w') as f:
-            json.dump(sites, f, indent=2)
+        output_file = os.environ.get(
+            'SDWAN_OUT', os.path.join(tempfile.gettempdir(), 'sdwan_sites_geocoded.json')
+        )
+        os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+        save_sites_json(sites, output_file)
         print(f"\nSites with geocoded locations saved to: {output_file}")
         
         # Print usage guide